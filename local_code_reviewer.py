@@ -1,9 +1,16 @@
 import os
+import functools
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from llama_cpp import Llama
-import json
+from typing import List
+from llama_cpp import Llama, LlamaGrammar, llama_print_system_info
+import msgspec
 import re
+import hashlib
 import logging
+import mmap
 
 # Configure logging
 logging.basicConfig(
@@ -15,201 +22,408 @@ logging.basicConfig(
 # Configuration
 CODEBASE_DIR = "./your_codebase"
 OUTPUT_DIR = "./code_reviews"
-MODEL_PATH = "./models/qwen2.5-coder-7b-instruct-q8_0.gguf"
+CACHE_DIR = os.path.join(OUTPUT_DIR, ".cache")
+PROMPT_VERSION = "2"  # Bump when the prompt or grammar changes to invalidate cached reviews
+MODEL_QUANT = "q4_k_m"  # "q4_k_m", "q5_k_m", "q8_0", or "auto" to pick from the CPU flags
 SUPPORTED_EXTENSIONS = {".py", ".js", ".cpp", ".java", ".ts", ".html", ".css", ".go"}
+_SUPPORTED_SUFFIXES = {ext[1:] for ext in SUPPORTED_EXTENSIONS}
+N_CTX = 4096
+MAX_TOKENS = 1024  # Tokens reserved for the model's reply
+CHUNK_OVERLAP_TOKENS = 128  # Tokens repeated between chunks to keep context
+CHUNK_MARGIN_TOKENS = 32  # Slack for code tokenizing differently inside the prompt
+LARGE_FILE_BYTES = 1 << 20  # Files above this size are memory-mapped and chunked lazily
+MMAP_WINDOW_BYTES = 64 * 1024
+COMMENT_PREFIXES = ("//", "/*", '"""', "'''")  # Review items on comments/docstrings are dropped
+
+# GBNF grammar constraining the LLM output to the review JSON schema
+REVIEW_GRAMMAR = r"""
+root ::= "{" ws "\"bugs\":" ws issues "," ws "\"quality_issues\":" ws issues "," ws "\"suggestions\":" ws suggestions "," ws "\"security_concerns\":" ws issues ws "}"
+issues ::= "[" ws ( issue ( "," ws issue ){0,4} )? ws "]"
+issue ::= "{" ws "\"line\":" ws line "," ws "\"code\":" ws string "," ws "\"description\":" ws string ws "}"
+suggestions ::= "[" ws ( suggestion ( "," ws suggestion ){0,4} )? ws "]"
+suggestion ::= "{" ws "\"line\":" ws line "," ws "\"code\":" ws string "," ws "\"fix\":" ws string "," ws "\"description\":" ws string ws "}"
+line ::= [1-9] [0-9]{0,5}
+string ::= "\"" ( [^"\\\x7F\x00-\x1F] | "\\" ( ["\\/bfnrt] | "u" [0-9a-fA-F]{4} ) )* "\""
+ws ::= | " " | "\n" [ \t]{0,20}
+"""
+
+# Review schema, decoded straight from the LLM output
+class ReviewItem(msgspec.Struct):
+    line: int
+    code: str
+    description: str
+
+class SuggestionItem(msgspec.Struct):
+    line: int
+    code: str
+    fix: str
+    description: str
+
+class Review(msgspec.Struct):
+    bugs: List[ReviewItem] = msgspec.field(default_factory=list)
+    quality_issues: List[ReviewItem] = msgspec.field(default_factory=list)
+    suggestions: List[SuggestionItem] = msgspec.field(default_factory=list)
+    security_concerns: List[ReviewItem] = msgspec.field(default_factory=list)
+
+class PartialReview(Review):
+    """A merged review in which some chunks failed; it is shown but never cached."""
+    chunk_errors: List[str] = msgspec.field(default_factory=list)
+
+class ReviewError(msgspec.Struct, omit_defaults=True):
+    error: str
+    raw_output: str = ""
+
+MODEL_QUANTS = ("q4_k_m", "q5_k_m", "q8_0")
+
+def model_path(quant):
+    """Return the GGUF path for a model quantization."""
+    return f"./models/qwen2.5-coder-7b-instruct-{quant}.gguf"
+
+def read_cpu_flags():
+    """Return the contents of /proc/cpuinfo, or an empty string where it is unavailable."""
+    try:
+        with open("/proc/cpuinfo", "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return ""
+
+def detect_model_quant():
+    """Pick a downloaded model quantization, preferring one suited to the CPU."""
+    flags = read_cpu_flags()
+    # VNNI hosts run Q4_K_M dot products on int8 VPDPBUSD instructions
+    preferred = "q4_k_m" if "avx512_vnni" in flags or "avx_vnni" in flags else "q5_k_m"
+    for quant in (preferred, *MODEL_QUANTS):
+        if os.path.exists(model_path(quant)):
+            return quant
+    return preferred
+
+if MODEL_QUANT == "auto":
+    MODEL_QUANT = detect_model_quant()
+MODEL_PATH = model_path(MODEL_QUANT)
+logging.info(f"Using model {MODEL_PATH}")
+
+MODEL_LAYERS = 28  # Transformer layers in Qwen2.5-Coder-7B
+N_THREADS = max(1, (os.cpu_count() or 2) // 2)  # Physical cores on SMT hosts
+
+def llama_rebuild_cmd(cpu_vnni):
+    """Return the pip command rebuilding llama_cpp for this CPU."""
+    # AVX-512 builds crash with an illegal instruction on CPUs without it
+    simd_args = "-DGGML_AVX512=on -DGGML_AVX512_VNNI=on" if cpu_vnni else "-DGGML_NATIVE=on"
+    return (
+        f'CMAKE_ARGS="-DGGML_CUDA=on {simd_args}" '
+        "pip install --force-reinstall --no-binary :all: llama-cpp-python"
+    )
+
+def check_llama_build():
+    """Warn when the installed llama_cpp wheel was built without SIMD/GPU support."""
+    info = llama_print_system_info().decode("utf-8", errors="replace")
+    flags = dict(re.findall(r'(\w+) = (\d+)', info))
+
+    def enabled(name):
+        return flags.get(name, "0") != "0" or f"{name} :" in info
+
+    if enabled("NEON") and enabled("DOTPROD"):
+        return True
+    # Only require AVX512_VNNI in CPU-only builds when the CPU actually has it
+    cpu_vnni = "avx512_vnni" in read_cpu_flags()
+    if enabled("AVX2") and (enabled("CUDA") or enabled("AVX512_VNNI") or not cpu_vnni):
+        return True
+    message = (
+        f"llama_cpp was built without SIMD/GPU support this machine has ({info.strip()}). "
+        f"Rebuild it with:\n  {llama_rebuild_cmd(cpu_vnni)}"
+    )
+    logging.warning(message)
+    print(message)
+    return False
+
+def free_vram_bytes():
+    """Return the free memory on GPU 0 in bytes, or None if it cannot be queried."""
+    try:
+        import torch
+        if torch.cuda.is_available():
+            return torch.cuda.mem_get_info(0)[0]
+    except Exception:
+        # torch missing, or CUDA present but unusable
+        pass
+    try:
+        import pynvml
+        pynvml.nvmlInit()
+        try:
+            return pynvml.nvmlDeviceGetMemoryInfo(pynvml.nvmlDeviceGetHandleByIndex(0)).free
+        finally:
+            pynvml.nvmlShutdown()
+    except Exception:
+        return None
+
+def pick_gpu_layers():
+    """Pick how many layers fit in free VRAM, -1 meaning all of them."""
+    free = free_vram_bytes()
+    if free is None:
+        return -1
+    layer_bytes = os.path.getsize(MODEL_PATH) / MODEL_LAYERS
+    # Keep ~10% headroom for the KV cache and compute buffers
+    fit = int(free * 0.9 // layer_bytes)
+    return -1 if fit >= MODEL_LAYERS else fit
+
+def load_model():
+    """Load the LLM with as many layers on the GPU as will fit."""
+    if not os.path.exists(MODEL_PATH):
+        # Llama raises ValueError for this too, which must not be retried as an OOM
+        logging.error(f"Model file {MODEL_PATH} does not exist")
+        raise FileNotFoundError(f"Model file {MODEL_PATH} does not exist")
+    n_gpu_layers = pick_gpu_layers()
+    while True:
+        try:
+            return Llama(
+                model_path=MODEL_PATH,
+                n_ctx=N_CTX,
+                n_threads=N_THREADS,
+                n_gpu_layers=n_gpu_layers,
+                main_gpu=0,
+                tensor_split=None,
+                offload_kqv=True,
+                flash_attn=True,  # Fused attention kernels cut KV cache bandwidth
+                n_batch=512,  # Evaluate up to 512 prompt tokens per batch
+                n_ubatch=512,
+                verbose=False
+            )
+        except (RuntimeError, ValueError) as e:
+            if n_gpu_layers == 0:
+                raise
+            # Partial offload is slow, so only back off when the model does not fit
+            n_gpu_layers = MODEL_LAYERS // 2 if n_gpu_layers < 0 else n_gpu_layers // 2
+            logging.warning(f"Model load failed ({str(e)}), retrying with n_gpu_layers={n_gpu_layers}")
 
 # Initialize the LLM with GPU support
-llm = Llama(
-    model_path=MODEL_PATH,
-    n_ctx=4096,
-    n_threads=8,
-    n_gpu_layers=10,  # Offload 10 layers to GPU (adjust if VRAM error)
-    verbose=False
-)
+check_llama_build()
+llm = load_model()
+review_grammar = LlamaGrammar.from_string(REVIEW_GRAMMAR, verbose=False)
 
 def read_code_file(file_path):
-    """Read content of a code file, splitting into chunks if necessary."""
+    """Read a code file's bytes, memory-mapping it if it is large."""
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            content = f.read()
-            if len(content) > 3000:
-                logging.info(f"Chunking file {file_path} due to large size")
-                return [content[i:i+3000] for i in range(0, len(content), 3000)]
-            return content
+        if os.path.getsize(file_path) > LARGE_FILE_BYTES:
+            with open(file_path, "rb") as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return Path(file_path).read_bytes()
     except Exception as e:
         logging.error(f"Error reading file {file_path}: {str(e)}")
         return f"Error reading file: {str(e)}"
 
+def chunk_code(content, file_path):
+    """Return the code as a string, or an iterator of (first line, chunk) pairs if it is too large.
+
+    This tokenizes with the model, so it must run on the LLM thread.
+    """
+    file_name = Path(file_path).name
+    language = LANGUAGE_MAP.get(Path(file_path).suffix.lower(), "Unknown")
+    budget = chunk_token_budget(language) - len(llm.tokenize(file_name.encode("utf-8"), add_bos=False))
+    if isinstance(content, mmap.mmap):
+        logging.info(f"Chunking file {file_path} lazily due to large size")
+        return iter_large_file_chunks(content, budget)
+    tokens = llm.tokenize(content, add_bos=False)
+    if len(tokens) > budget:
+        logging.info(f"Chunking file {file_path} due to large size")
+        return split_tokens(tokens, budget)
+    return content.decode("utf-8", errors="replace")
+
+@functools.lru_cache(maxsize=None)
+def chunk_token_budget(language):
+    """Return how many code and file name tokens fit in one prompt alongside the reply."""
+    # The prompt only varies by language apart from the file name and code
+    prompt = build_prompt("", "", language, 9999)
+    return N_CTX - len(llm.tokenize(prompt.encode("utf-8"), special=True)) - MAX_TOKENS - CHUNK_MARGIN_TOKENS
+
+def split_tokens(tokens, budget, first_line=1):
+    """Lazily split code tokens into overlapping (first line, chunk) pairs that end on line breaks."""
+    start = 0
+    while True:
+        end = min(start + budget, len(tokens))
+        if end < len(tokens):
+            # Back up to the last line break so statements are not cut in half
+            for i in range(end - 1, start + CHUNK_OVERLAP_TOKENS, -1):
+                if b"\n" in llm.detokenize([tokens[i]]):
+                    end = i + 1
+                    break
+        # Only decode a chunk once the review actually consumes it
+        chunk = llm.detokenize(tokens[start:end])
+        yield first_line, chunk.decode("utf-8", errors="replace")
+        if end == len(tokens):
+            return
+        start = end - CHUNK_OVERLAP_TOKENS
+        # The next chunk starts on the line holding the first overlap token
+        first_line += chunk.count(b"\n") - llm.detokenize(tokens[start:end]).count(b"\n")
+
+def iter_large_file_chunks(mm, budget):
+    """Lazily yield (first line, chunk) pairs of a memory-mapped file one window at a time, then close the map."""
+    with mm:
+        size = len(mm)
+        start = 0
+        line = 1
+        while start < size:
+            end = min(start + MMAP_WINDOW_BYTES, size)
+            if end < size:
+                # End the window on a line break so tokens and UTF-8 sequences stay whole
+                newline = mm.rfind(b"\n", start, end)
+                if newline > start:
+                    end = newline + 1
+            window = mm[start:end]
+            tokens = llm.tokenize(window, add_bos=False)
+            if len(tokens) > budget:
+                yield from split_tokens(tokens, budget, line)
+            else:
+                yield line, window.decode("utf-8", errors="replace")
+            line += window.count(b"\n")
+            start = end
+
 def clean_json_string(text):
-    """Attempt to clean and extract valid JSON from LLM output."""
+    """Decode the grammar-constrained LLM output into a Review."""
     text = text.strip()
-    # Remove BOM and non-printable characters
-    text = text.encode('utf-8').decode('utf-8-sig')
-    text = re.sub(r'[^\x20-\x7E\n\r\t]', '', text)
-    # Extract JSON from ```json ``` markers or raw JSON
-    json_match = re.search(r'```json\s*(\{[\s\S]*?\})\s*```|\{[\s\S]*?\}', text, re.DOTALL)
-    if not json_match:
-        logging.error(f"No valid JSON found in LLM output: {text}")
-        return json.dumps({
-            "error": "No valid JSON found in output",
-            "raw_output": text
-        }, indent=2)
-    
-    json_str = json_match.group(1) or json_match.group(0)
-    # Replace single quotes with double quotes
-    json_str = json_str.replace("'", '"')
-    # Remove trailing commas
-    json_str = re.sub(r',\s*([}\]])', r'\1', json_str)
-    json_str = re.sub(r',\s*(?=\n\s*[}\]])', '', json_str)
-    json_str = re.sub(r',,+', ',', json_str)
-    # Truncate at last valid closing brace
-    last_brace = json_str.rfind('}')
-    if last_brace != -1:
-        json_str = json_str[:last_brace+1]
-    # Log raw and cleaned JSON
-    logging.info(f"Raw LLM output: {text}")
-    logging.info(f"Cleaned JSON string: {json_str}")
-    try:
-        json_dict = json.loads(json_str)
-        return json.dumps(json_dict, indent=2)
-    except json.JSONDecodeError as e:
-        logging.error(f"JSON parsing failed: {str(e)} at line {e.lineno}, column {e.colno}")
-        # Fallback: reconstruct minimal valid JSON
-        fallback_json = {
-            "bugs": [],
-            "quality_issues": [],
-            "suggestions": [],
-            "security_concerns": []
-        }
-        logging.info(f"Fallback JSON used for {json_str}")
-        return json.dumps(fallback_json, indent=2)
-
-def filter_invalid_suggestions(review_json, file_name):
-    """Filter out invalid suggestions or quality issues."""
+    # Remove BOM
+    if text.startswith('\ufeff'):
+        text = text[1:]
+    # Full LLM output is only worth formatting when debugging
+    logging.debug("Raw LLM output: %s", text)
+    if not text.startswith("{"):
+        logging.error("No valid JSON found in LLM output: %s", text)
+        return ReviewError(error="No valid JSON found in output", raw_output=text)
     try:
-        review = json.loads(review_json)
-        if "error" in review:
-            return review_json
-        
-        # Filter quality_issues and suggestions
-        for key in ["quality_issues", "suggestions"]:
-            filtered = []
-            for item in review[key]:
-                code = item.get("code", "").strip()
-                description = item.get("description", "").lower()
-                # Skip if code is a comment/docstring or description mentions comments
-                if not (code.startswith("//") or code.startswith("/*") or code.startswith('"""') or code.startswith("'''") or "comment" in description):
-                    filtered.append(item)
-                else:
-                    logging.info(f"Filtered out {key} item for {file_name}: {code}")
-            review[key] = filtered
-        return json.dumps(review, indent=2)
-    except json.JSONDecodeError:
-        return review_json
-
-def format_review_for_display(review_json, file_name):
-    """Format the review JSON for human-readable CMD and text file output."""
-    try:
-        review = json.loads(review_json)
-        if "error" in review:
-            return f"\n=== Error Reviewing {file_name} ===\n\nError: {review['error']}\n\nRaw Output:\n{review['raw_output']}\n\n{'=' * 80}\n"
-        
-        output = f"\n=== Code Review for {file_name} ===\n\n{'-' * 80}\n"
-        
-        output += "Bugs:\n"
-        if review["bugs"]:
-            for bug in review["bugs"]:
-                output += f"\n  Line {bug['line']}:\n"
-                output += f"    Code       : {bug['code']}\n"
-                output += f"    Description: {bug['description']}\n"
-        else:
-            output += "\n  None\n"
-        
-        output += "\nQuality Issues:\n"
-        if review["quality_issues"]:
-            for issue in review["quality_issues"]:
-                output += f"\n  Line {issue['line']}:\n"
-                output += f"    Code       : {issue['code']}\n"
-                output += f"    Description: {issue['description']}\n"
-        else:
-            output += "\n  None\n"
-        
-        output += "\nSuggestions:\n"
-        if review["suggestions"]:
-            for suggestion in review["suggestions"]:
-                output += f"\n  Line {suggestion['line']}:\n"
-                output += f"    Code       : {suggestion['code']}\n"
-                output += f"    Fix        : {suggestion['fix']}\n"
-                output += f"    Description: {suggestion['description']}\n"
-        else:
-            output += "\n  None\n"
-        
-        output += "\nSecurity Concerns:\n"
-        if review["security_concerns"]:
-            for concern in review["security_concerns"]:
-                output += f"\n  Line {concern['line']}:\n"
-                output += f"    Code       : {concern['code']}\n"
-                output += f"    Description: {concern['description']}\n"
-        else:
-            output += "\n  None\n"
-        
-        output += f"\n{'=' * 80}\n"
-        return output
-    except json.JSONDecodeError:
-        logging.error(f"Invalid JSON format for review of {file_name}")
-        return f"\n=== Error Formatting Review for {file_name} ===\n\nError: Invalid JSON\n\n{'=' * 80}\n"
+        return msgspec.json.decode(text, type=Review)
+    except msgspec.DecodeError as e:
+        # The grammar guarantees valid JSON unless generation hit max_tokens
+        logging.error("JSON parsing failed: %s", e)
+        return ReviewError(error=f"Invalid JSON in LLM output (possibly cut off at max_tokens): {e}", raw_output=text)
+
+def filter_invalid_suggestions(review, file_name):
+    """Filter out invalid suggestions or quality issues from a Review."""
+    if isinstance(review, ReviewError):
+        return review
+
+    # Filter quality_issues and suggestions
+    for key in ["quality_issues", "suggestions"]:
+        filtered = []
+        for item in getattr(review, key):
+            code = item.code.strip()
+            description = item.description.lower()
+            # Skip if code is a comment/docstring or description mentions comments
+            if not (code.startswith(COMMENT_PREFIXES) or "comment" in description):
+                filtered.append(item)
+            else:
+                logging.info("Filtered out %s item for %s: %s", key, file_name, code)
+        setattr(review, key, filtered)
+    return review
+
+def format_review_for_display(review, file_name):
+    """Format the Review for human-readable CMD and text file output."""
+    if isinstance(review, ReviewError):
+        return f"\n=== Error Reviewing {file_name} ===\n\nError: {review.error}\n\nRaw Output:\n{review.raw_output}\n\n{'=' * 80}\n"
+
+    parts = ["", f"=== Code Review for {file_name} ===", "", "-" * 80]
+
+    parts.append("Bugs:")
+    if review.bugs:
+        for bug in review.bugs:
+            parts.extend((
+                "",
+                f"  Line {bug.line}:",
+                f"    Code       : {bug.code}",
+                f"    Description: {bug.description}"
+            ))
+    else:
+        parts.extend(("", "  None"))
+
+    parts.extend(("", "Quality Issues:"))
+    if review.quality_issues:
+        for issue in review.quality_issues:
+            parts.extend((
+                "",
+                f"  Line {issue.line}:",
+                f"    Code       : {issue.code}",
+                f"    Description: {issue.description}"
+            ))
+    else:
+        parts.extend(("", "  None"))
+
+    parts.extend(("", "Suggestions:"))
+    if review.suggestions:
+        for suggestion in review.suggestions:
+            parts.extend((
+                "",
+                f"  Line {suggestion.line}:",
+                f"    Code       : {suggestion.code}",
+                f"    Fix        : {suggestion.fix}",
+                f"    Description: {suggestion.description}"
+            ))
+    else:
+        parts.extend(("", "  None"))
+
+    parts.extend(("", "Security Concerns:"))
+    if review.security_concerns:
+        for concern in review.security_concerns:
+            parts.extend((
+                "",
+                f"  Line {concern.line}:",
+                f"    Code       : {concern.code}",
+                f"    Description: {concern.description}"
+            ))
+    else:
+        parts.extend(("", "  None"))
+
+    if isinstance(review, PartialReview):
+        parts.extend(("", "Failed Chunks:"))
+        for error in review.chunk_errors:
+            parts.extend(("", f"  {error}"))
+
+    parts.extend(("", "=" * 80, ""))
+    return "\n".join(parts)
 
 def save_review(file_name, review):
-    """Save the review to a JSON file and a human-readable text file."""
+    """Save the Review to a JSON file and a human-readable text file, returning the JSON."""
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     file_stem = Path(file_name).stem
     json_path = os.path.join(OUTPUT_DIR, f"{file_stem}_review.json")
     txt_path = os.path.join(OUTPUT_DIR, f"{file_stem}_review.txt")
     
-    with open(json_path, "w", encoding="utf-8") as f:
-        f.write(review)
-    
-    with open(txt_path, "w", encoding="utf-8") as f:
-        f.write(format_review_for_display(review, file_name))
+    review_json = msgspec.json.format(msgspec.json.encode(review), indent=2).decode()
+    Path(json_path).write_text(review_json, encoding="utf-8")
+    Path(txt_path).write_text(format_review_for_display(review, file_name), encoding="utf-8")
     logging.info(f"Review saved for {file_name} at {json_path} and {txt_path}")
+    return review_json
 
-def generate_review(code, file_name):
-    """Generate a code review using the LLM."""
-    ext = Path(file_name).suffix.lower()
-    lang_map = {
-        ".py": "Python", 
-        ".js": "JavaScript", 
-        ".cpp": "C++", 
-        ".java": "Java", 
-        ".ts": "TypeScript",
-        ".html": "HTML",
-        ".css": "CSS",
-        ".go": "Go"
-    }
-    language = lang_map.get(ext, "Unknown")
-
-    if isinstance(code, list):
-        reviews = []
-        for i, chunk in enumerate(code):
-            review = generate_review_chunk(chunk, file_name, language, i)
-            reviews.append(review)
-        try:
-            aggregated = {"bugs": [], "quality_issues": [], "suggestions": [], "security_concerns": []}
-            for review in reviews:
-                review_dict = json.loads(review)
-                for key in aggregated:
-                    aggregated[key].extend(review_dict.get(key, []))
-            return filter_invalid_suggestions(json.dumps(aggregated, indent=2), file_name)
-        except json.JSONDecodeError:
-            logging.error(f"Failed to aggregate chunked reviews for {file_name}")
-            return json.dumps({"error": "Failed to aggregate chunked reviews", "raw_outputs": reviews}, indent=2)
-    
-    return filter_invalid_suggestions(generate_review_chunk(code, file_name, language, 0), file_name)
+def review_cache_key(file_path, content):
+    """Hash the file content together with the model, prompt version and file extension."""
+    ext = Path(file_path).suffix.lower()
+    digest = hashlib.sha256(b"\0".join((MODEL_PATH.encode("utf-8"), PROMPT_VERSION.encode("utf-8"), ext.encode("utf-8"), b"")))
+    digest.update(content)
+    return digest.hexdigest()
+
+def load_cached_review(cache_key):
+    """Return the cached Review for a cache key, or None on a miss."""
+    try:
+        return msgspec.json.decode(Path(CACHE_DIR, f"{cache_key}.json").read_bytes(), type=Review)
+    except (OSError, msgspec.DecodeError):
+        return None
+
+def save_cached_review(cache_key, review_json):
+    """Store a serialized review under its cache key."""
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    Path(CACHE_DIR, f"{cache_key}.json").write_text(review_json, encoding="utf-8")
+
+LANGUAGE_MAP = {
+    ".py": "Python",
+    ".js": "JavaScript",
+    ".cpp": "C++",
+    ".java": "Java",
+    ".ts": "TypeScript",
+    ".html": "HTML",
+    ".css": "CSS",
+    ".go": "Go"
+}
 
-def generate_review_chunk(code, file_name, language, chunk_index):
-    """Generate a review for a single code chunk."""
-    prompt = f"""
-You are an expert code reviewer for {language} code. Review the following code from file '{file_name}' (chunk {chunk_index}) and provide a structured review in **valid JSON format** (use double quotes, no trailing commas). Include exactly these keys:
+# The preamble only depends on the language, so consecutive chunks of the same
+# language share a prompt prefix; everything chunk-specific goes in the tail.
+STATIC_PREAMBLE = """
+You are an expert code reviewer for {language} code. Review the code from the file given below and provide a structured review in **valid JSON format** (use double quotes, no trailing commas). Include exactly these keys:
 - "bugs": Array of potential bugs or errors (up to 5, e.g., type errors, null/undefined handling). Each entry must have "line" (line number, 1-based), "code" (exact code snippet), and "description" (issue explanation).
 - "quality_issues": Array of code quality issues (up to 5, e.g., readability, structure). Each entry must have "line" (line number, 1-based), "code" (exact code snippet), and "description" (issue explanation). Do not overlap with bugs.
 - "suggestions": Array of actionable improvements (up to 5, e.g., f-strings for Python, template literals/JSDoc for JavaScript, type hints for Python). Each entry must have "line" (line number, 1-based), "code" (exact code snippet), "fix" (example fix), and "description" (why the fix is better).
@@ -228,33 +442,177 @@ Rules:
 - Return empty arrays if no issues are found.
 - Ensure valid JSON with no trailing commas, hidden characters, or syntax errors.
 
+"""
+
+VARIABLE_TAIL = """File: '{file_name}' (chunk {chunk_index})
+
 Code:
 ```
 {code}
 ```
-Return the JSON object enclosed in ```json ``` markers.
+Return only the JSON object.
 """
+
+class _PromptFields(dict):
+    """Prompt fields that leave unknown placeholders untouched."""
+    def __missing__(self, key):
+        return "{" + key + "}"
+
+# Preambles and full prompt templates baked once per language; only the file
+# name, chunk index and code are filled in per chunk
+PREAMBLES = {language: STATIC_PREAMBLE.format(language=language) for language in [*LANGUAGE_MAP.values(), "Unknown"]}
+PROMPTS = {language: preamble + VARIABLE_TAIL for language, preamble in PREAMBLES.items()}
+
+def build_prompt(code, file_name, language, chunk_index):
+    """Build the review prompt for a single code chunk."""
+    return PROMPTS[language].format_map(_PromptFields(file_name=file_name, chunk_index=chunk_index, code=code))
+
+def build_review_jobs(code, file_name):
+    """Yield the (chunk index, first line, prompt) jobs for a file's code."""
+    language = LANGUAGE_MAP.get(Path(file_name).suffix.lower(), "Unknown")
+    chunks = [(1, code)] if isinstance(code, str) else code
+    for i, (first_line, chunk) in enumerate(chunks):
+        yield i, first_line, build_prompt(chunk, file_name, language, i)
+
+def merge_chunk_reviews(reviews, file_name):
+    """Merge the (first line, review) pairs of a file's chunks into a single filtered review."""
+    if len(reviews) == 1:
+        return filter_invalid_suggestions(reviews[0][1], file_name)
+    errors = [review for _, review in reviews if isinstance(review, ReviewError)]
+    if len(errors) == len(reviews):
+        return ReviewError(
+            error=f"All {len(reviews)} chunks failed: {errors[0].error}",
+            raw_output="\n\n".join(error.raw_output for error in errors if error.raw_output)
+        )
+    # Keep the findings of the chunks that succeeded, but mark the review as
+    # partial so it is not cached as if the whole file was reviewed
+    if errors:
+        logging.error(f"{len(errors)} of {len(reviews)} chunks failed for {file_name}")
+        aggregated = PartialReview(chunk_errors=[
+            f"Chunk {i}: {review.error}" for i, (_, review) in enumerate(reviews) if isinstance(review, ReviewError)
+        ])
+    else:
+        aggregated = Review()
+    seen = set()
+    for first_line, review in reviews:
+        if isinstance(review, ReviewError):
+            continue
+        for key in ["bugs", "quality_issues", "suggestions", "security_concerns"]:
+            merged = getattr(aggregated, key)
+            for item in getattr(review, key):
+                # The model numbers lines from the start of its chunk
+                item.line += first_line - 1
+                # Overlapping chunks report findings on shared lines twice
+                identity = (key, item.line, item.code, item.description)
+                if identity not in seen:
+                    seen.add(identity)
+                    merged.append(item)
+    return filter_invalid_suggestions(aggregated, file_name)
+
+def generate_review(code, file_name):
+    """Generate a code review using the LLM from a code string or an iterator of chunks."""
+    reviews = [
+        (first_line, run_completion(file_name, i, prompt))
+        for i, first_line, prompt in build_review_jobs(code, file_name)
+    ]
+    return merge_chunk_reviews(reviews, file_name)
+
+def read_json_stream(stream):
+    """Collect streamed completion text, stopping as soon as the top-level JSON object closes."""
+    parts = []
+    depth = 0
+    in_string = escaped = False
+    for chunk in stream:
+        text = chunk["choices"][0]["text"]
+        parts.append(text)
+        for i, ch in enumerate(text):
+            # Braces inside strings (e.g. code snippets) do not count
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif ch == "\\":
+                    escaped = True
+                elif ch == '"':
+                    in_string = False
+            elif ch == '"':
+                in_string = True
+            elif ch == "{":
+                depth += 1
+            elif ch == "}":
+                depth -= 1
+                if depth == 0:
+                    parts[-1] = text[:i + 1]
+                    stream.close()
+                    return "".join(parts)
+    return "".join(parts)
+
+def run_completion(file_name, chunk_index, prompt):
+    """Run a review prompt through the LLM and return the decoded Review."""
     try:
-        response = llm(
+        # create_completion keeps the KV cache for the longest prefix shared with
+        # the previous prompt, so a same-language chunk only evaluates its tail.
+        # Saved states are avoided: each holds a ~300 MB copy of the logits.
+        stream = llm.create_completion(
             prompt,
-            max_tokens=1024,
+            max_tokens=MAX_TOKENS,
             temperature=0.3,
-            stop=["</s>"]
+            stop=["</s>"],
+            grammar=review_grammar,
+            stream=True
         )
-        raw_output = response["choices"][0]["text"]
-        cleaned_output = clean_json_string(raw_output)
-        try:
-            json.loads(cleaned_output)
-            return cleaned_output
-        except json.JSONDecodeError:
-            logging.error(f"Invalid JSON after cleaning for {file_name}, chunk {chunk_index}")
-            return json.dumps({
-                "error": "LLM produced invalid JSON",
-                "raw_output": raw_output
-            }, indent=2)
+        return clean_json_string(read_json_stream(stream))
     except Exception as e:
         logging.error(f"LLM inference failed for {file_name}, chunk {chunk_index}: {str(e)}")
-        return json.dumps({"error": f"LLM inference failed: {str(e)}"}, indent=2)
+        return ReviewError(error=f"LLM inference failed: {str(e)}")
+
+def publish_review(file_name, review, cache_key=None):
+    """Save a finished review, caching it when a key is given, and print it to the console."""
+    review_json = save_review(file_name, review)
+    if cache_key is not None and isinstance(review, Review) and not isinstance(review, PartialReview):
+        save_cached_review(cache_key, review_json)
+    print(format_review_for_display(review, file_name))
+    print(f"Review saved for {file_name}")
+
+def _iter_code_files(root):
+    """Yield DirEntry objects for supported code files under root, skipping hidden directories."""
+    subdirs = []
+    try:
+        with os.scandir(root) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith("."):
+                        subdirs.append(entry.path)
+                    continue
+                # Like Path.suffix, names without a stem ("py", ".py") have no extension
+                head, dot, ext = entry.name.rpartition(".")
+                if dot and head and ext in _SUPPORTED_SUFFIXES and entry.is_file():
+                    yield entry
+    except OSError as e:
+        # Skip unreadable directories like os.walk does
+        logging.error(f"Error scanning directory {root}: {str(e)}")
+    for subdir in subdirs:
+        yield from _iter_code_files(subdir)
+
+def load_code_file(file_path):
+    """Return (cache key, cached review, content); content is an error message if reading failed."""
+    content = read_code_file(file_path)
+    if isinstance(content, str):
+        return None, None, content
+    cache_key = review_cache_key(file_path, content)
+    cached = load_cached_review(cache_key)
+    if cached is not None:
+        if isinstance(content, mmap.mmap):
+            content.close()
+        return cache_key, cached, None
+    return cache_key, None, content
+
+def queue_code_files(file_queue, read_pool):
+    """Walk the codebase and queue (path, pending load) pairs, ending with None."""
+    try:
+        for entry in _iter_code_files(CODEBASE_DIR):
+            file_queue.put((entry.path, read_pool.submit(load_code_file, entry.path)))
+    finally:
+        file_queue.put(None)
 
 def main():
     """Process all code files in the codebase directory."""
@@ -264,29 +622,37 @@ def main():
         print(f"Codebase directory {CODEBASE_DIR} does not exist")
         return
 
-    for root, _, files in os.walk(CODEBASE_DIR):
-        for file in files:
-            if Path(file).suffix in SUPPORTED_EXTENSIONS:
-                file_path = os.path.join(root, file)
-                logging.info(f"Reviewing {file_path}")
-                print(f"Reviewing {file_path}...")
-                code = read_code_file(file_path)
-                if isinstance(code, str) and "Error" in code:
-                    print(code)
-                    logging.error(code)
-                    continue
-                review = generate_review(code, file)
-                try:
-                    json.loads(review)
-                    save_review(file, review)
-                    print(format_review_for_display(review, file))
-                    print(f"Review saved for {file}")
-                except json.JSONDecodeError:
-                    logging.error(f"Invalid review format for {file}")
-                    print(f"Invalid review format for {file}")
-                    save_review(file, json.dumps({"error": "Invalid LLM response format after cleaning"}, indent=2))
-                    print(format_review_for_display(review, file))
-                    print(f"Fallback review saved for {file}")
+    # The LLM runs on this thread while files are read ahead and finished
+    # reviews are formatted and written in the background. llama_cpp is not
+    # re-entrant, so readers only return bytes and every llm call, including
+    # tokenization, stays on this thread. A single output worker keeps the
+    # console output in file order.
+    file_queue = queue.Queue(maxsize=8)
+    outputs = []
+    with ThreadPoolExecutor(max_workers=4) as read_pool, ThreadPoolExecutor(max_workers=1) as output_pool:
+        producer = threading.Thread(target=queue_code_files, args=(file_queue, read_pool), daemon=True)
+        producer.start()
+        while (item := file_queue.get()) is not None:
+            file_path, pending_load = item
+            file = os.path.basename(file_path)
+            cache_key, cached, content = pending_load.result()
+            if cached is not None:
+                logging.info(f"Using cached review for {file_path}")
+                print(f"Using cached review for {file_path}...")
+                outputs.append(output_pool.submit(publish_review, file, cached))
+                continue
+            logging.info(f"Reviewing {file_path}")
+            print(f"Reviewing {file_path}...")
+            if isinstance(content, str):
+                print(content)
+                logging.error(content)
+                continue
+            review = generate_review(chunk_code(content, file_path), file)
+            outputs.append(output_pool.submit(publish_review, file, review, cache_key))
+        producer.join()
+        # Re-raise any error from saving or formatting a review
+        for output in outputs:
+            output.result()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()